@@ -6,12 +6,20 @@ Copyright (C) 2017-2018 Jiri Borovec <jiri.borovec@fel.cvut.cz>
 
 import os
 import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
 from PIL import Image
 
 LANDMARK_COORDS = ['Y', 'X']
+# type of landmark coordinates, the single precision is enough for pixels
+LANDMARK_DTYPE = np.float32
+# already found paths by `update_path` for (working dir, path, depth)
+CACHE_UPDATED_PATHS = OrderedDict()
+# maximal number of cached paths, the least recently used are dropped
+CACHE_UPDATED_PATHS_SIZE = 4096
 
 
 def create_dir(path_dir):
@@ -28,7 +36,7 @@ def create_dir(path_dir):
 
 
 def load_landmarks(path_file):
-    """ load landmarks in csv and txt format
+    """ load landmarks in csv, txt and npy format
 
     :param str path_file: path to the input file
     :return: np.array<np_points, dim>
@@ -41,22 +49,59 @@ def load_landmarks(path_file):
     True
     >>> os.remove('./sample_landmarks.csv')
     >>> os.remove('./sample_landmarks.txt')
+    >>> save_landmarks('./sample_landmarks.npy', points)
+    >>> points3 = load_landmarks('./sample_landmarks.npy')
+    >>> np.array_equal(points1, points3)
+    True
+    >>> os.remove('./sample_landmarks.npy')
     """
     assert os.path.isfile(path_file), 'missing file "%s"' % path_file
     ext = os.path.splitext(path_file)[-1]
     if ext == '.csv':
-        return load_landmarks_csv(path_file)
+        return load_landmarks_csv(path_file, check_file=False)
     elif ext == '.txt':
-        return load_landmarks_txt(path_file)
+        return load_landmarks_txt(path_file, check_file=False)
+    elif ext == '.npy':
+        return load_landmarks_npy(path_file, check_file=False)
     else:
         logging.error('not supported landmarks file: %s',
                       os.path.basename(path_file))
 
 
-def load_landmarks_txt(path_file):
+def load_landmarks_batch(paths_file, nb_jobs=4):
+    """ load landmarks from many files using a pool of threads, the loading
+    is mostly waiting for disk so the threads overlap the latencies
+
+    :param [str] paths_file: paths to the input files
+    :param int nb_jobs: number of threads loading in parallel
+    :return [np.array<np_points, dim>]: landmarks in the same order as paths
+
+    >>> points = np.array([[1, 2], [3, 4], [5, 6]])
+    >>> save_landmarks('./sample_landmarks.csv', points)
+    >>> lnds = load_landmarks_batch(['./sample_landmarks.csv',
+    ...                              './sample_landmarks.txt'], nb_jobs=2)
+    >>> [np.array_equal(points, pts) for pts in lnds]
+    [True, True]
+    >>> os.remove('./sample_landmarks.csv')
+    >>> os.remove('./sample_landmarks.txt')
+    """
+    paths_file = list(paths_file)
+    if nb_jobs <= 1 or len(paths_file) <= 1:
+        return [load_landmarks(p) for p in paths_file]
+    pool = ThreadPool(min(nb_jobs, len(paths_file)))
+    try:
+        landmarks = pool.map(load_landmarks, paths_file)
+    finally:
+        pool.close()
+        pool.join()
+    return landmarks
+
+
+def load_landmarks_txt(path_file, check_file=True):
     """ load file with landmarks in txt format
 
     :param str path_file: path to the input file
+    :param bool check_file: verify that the input file exists
     :return: np.array<np_points, dim>
 
     >>> points = np.array([[1, 2], [3, 4], [5, 6]])
@@ -65,91 +110,198 @@ def load_landmarks_txt(path_file):
     >>> pts  # doctest: +NORMALIZE_WHITESPACE
     array([[ 1.,  2.],
            [ 3.,  4.],
-           [ 5.,  6.]])
+           [ 5.,  6.]], dtype=float32)
     >>> os.remove('./sample_landmarks.txt')
     """
-    assert os.path.isfile(path_file), 'missing file "%s"' % path_file
+    if check_file:
+        assert os.path.isfile(path_file), 'missing file "%s"' % path_file
     with open(path_file, 'r') as fp:
-        data = fp.read()
-        lines = data.split('\n')
-        # lines = [re.sub("(\\r|)\\n$", '', line) for line in lines]
-    if len(lines) < 2:
-        logging.warning('invalid format: file has less then 2 lines, "%s"',
-                        repr(lines))
-        return np.zeros((0, 2))
-    nb_points = int(lines[1])
-    points = [[float(n) for n in line.split()] for line in lines[2:]]
+        # read just the header, the coordinates are parsed by numpy
+        lines = [fp.readline(), fp.readline()]
+        if not lines[1].strip():
+            logging.warning('invalid format: file has less then 2 lines, "%s"',
+                            repr(lines))
+            return np.zeros((0, 2), dtype=LANDMARK_DTYPE)
+        nb_points = int(lines[1])
+        if nb_points == 0:
+            return np.zeros((0, 2), dtype=LANDMARK_DTYPE)
+        points = np.loadtxt(fp, dtype=LANDMARK_DTYPE, ndmin=2)
     assert nb_points == len(points), 'number of declared (%i) and found (%i) ' \
                                      'does not match' % (nb_points, len(points))
-    return np.array(points, dtype=np.float)
+    return points
 
 
-def load_landmarks_csv(path_file):
+def load_landmarks_csv(path_file, check_file=True):
     """ load file with landmarks in cdv format
 
     :param str path_file: path to the input file
+    :param bool check_file: verify that the input file exists
     :return: np.array<np_points, dim>
 
     >>> points = np.array([[1, 2], [3, 4], [5, 6]])
     >>> save_landmarks_csv('./sample_landmarks.csv', points)
     >>> pts = load_landmarks_csv('./sample_landmarks.csv')
-    >>> pts  # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
-    array([[1, 2],
-           [3, 4],
-           [5, 6]]...)
+    >>> pts  # doctest: +NORMALIZE_WHITESPACE
+    array([[ 1.,  2.],
+           [ 3.,  4.],
+           [ 5.,  6.]], dtype=float32)
     >>> os.remove('./sample_landmarks.csv')
     """
-    assert os.path.isfile(path_file), 'missing file "%s"' % path_file
-    df = pd.read_csv(path_file, index_col=0)
+    if check_file:
+        assert os.path.isfile(path_file), 'missing file "%s"' % path_file
+    # parse only the coordinates with fixed type, skip the type inference,
+    # it also reads older files with a leading index column
+    df = pd.read_csv(path_file, usecols=LANDMARK_COORDS, engine='c',
+                     dtype={col: LANDMARK_DTYPE for col in LANDMARK_COORDS},
+                     memory_map=True)
     points = df[LANDMARK_COORDS].values
     return points
 
 
+def load_landmarks_npy(path_file, check_file=True):
+    """ load file with landmarks in binary numpy format
+
+    :param str path_file: path to the input file
+    :param bool check_file: verify that the input file exists
+    :return: np.array<np_points, dim>
+
+    >>> points = np.array([[1, 2], [3, 4], [5, 6]])
+    >>> save_landmarks_npy('./sample_landmarks.npy', points)
+    >>> pts = load_landmarks_npy('./sample_landmarks.npy')
+    >>> pts  # doctest: +NORMALIZE_WHITESPACE
+    array([[ 1.,  2.],
+           [ 3.,  4.],
+           [ 5.,  6.]], dtype=float32)
+    >>> os.remove('./sample_landmarks.npy')
+    """
+    if check_file:
+        assert os.path.isfile(path_file), 'missing file "%s"' % path_file
+    points = np.load(path_file).astype(LANDMARK_DTYPE, copy=False)
+    return points
+
+
 def save_landmarks(path_file, landmarks):
-    """ save landmarks into a specific file
+    """ save landmarks into a specific file, the npy format is kept as it is
+    and any other is exported as both csv and txt
 
     :param str path_file: path to the output file
     :param landmarks: np.array<np_points, dim>
     """
-    assert os.path.isdir(os.path.dirname(path_file)), \
-        'missing folder "%s"' % os.path.dirname(path_file)
-    path_file = os.path.splitext(path_file)[0]
-    save_landmarks_csv(path_file + '.csv', landmarks)
-    save_landmarks_txt(path_file + '.txt', landmarks)
+    path_dir = os.path.dirname(path_file)
+    assert os.path.isdir(path_dir), 'missing folder "%s"' % path_dir
+    path_file, ext = os.path.splitext(path_file)
+    if ext == '.npy':
+        save_landmarks_npy(path_file + ext, landmarks, check_folder=False)
+        return
+    # format the coordinates just once, both files share the same rows
+    lines = format_landmarks_lines(landmarks)
+    write_landmarks_csv(path_file + '.csv', lines)
+    write_landmarks_txt(path_file + '.txt', lines)
+
+
+def format_landmarks_lines(landmarks):
+    """ format landmarks into text lines with comma separated coordinates
+
+    :param landmarks: np.array<np_points, dim>
+    :return [str]: formatted lines
+
+    >>> format_landmarks_lines(np.array([[1, 2.5], [3.25, 4]]))
+    ['1,2.5', '3.25,4']
+    >>> format_landmarks_lines(np.array([[1, 2, 3]]))
+    ['1,2,3']
+    """
+    landmarks = np.asarray(landmarks).astype(LANDMARK_DTYPE, copy=False)
+    if landmarks.size == 0:
+        return []
+    landmarks = np.atleast_2d(landmarks)
+    fmt = ','.join(['%.8g'] * landmarks.shape[1])
+    lines = [fmt % tuple(pt) for pt in landmarks]
+    return lines
+
+
+def write_landmarks_txt(path_file, lines):
+    """ write already formatted landmarks into a txt file
+
+    :param str path_file: path to the output file
+    :param [str] lines: landmarks formatted by `format_landmarks_lines`
+    """
+    with open(path_file, 'w') as fp:
+        fp.write('point\n%i\n' % len(lines))
+        fp.write(''.join(ln + '\n' for ln in lines).replace(',', ' '))
+
+
+def write_landmarks_csv(path_file, lines):
+    """ write already formatted landmarks into a csv file, without any index
+
+    :param str path_file: path to the output file
+    :param [str] lines: landmarks formatted by `format_landmarks_lines`
+    """
+    assert not lines or lines[0].count(',') == len(LANDMARK_COORDS) - 1, \
+        'landmarks have to have %i coordinates' % len(LANDMARK_COORDS)
+    with open(path_file, 'w') as fp:
+        fp.write('%s\n' % ','.join(LANDMARK_COORDS))
+        fp.write(''.join(ln + '\n' for ln in lines))
 
 
-def save_landmarks_txt(path_file, landmarks):
+def save_landmarks_txt(path_file, landmarks, check_folder=True):
     """ save landmarks into a txt file
 
     :param str path_file: path to the output file
     :param landmarks: np.array<np_points, dim>
+    :param bool check_folder: verify that the output folder exists
+
+    >>> points = np.array([[1, 2, 3], [4, 5, 6]])
+    >>> save_landmarks_txt('./sample_landmarks.txt', points)
+    >>> load_landmarks_txt('./sample_landmarks.txt')  # doctest: +NORMALIZE_WHITESPACE
+    array([[ 1.,  2.,  3.],
+           [ 4.,  5.,  6.]], dtype=float32)
+    >>> os.remove('./sample_landmarks.txt')
     """
-    assert os.path.isdir(os.path.dirname(path_file)), \
-        'missing folder "%s"' % os.path.dirname(path_file)
-    lines = ['point', str(len(landmarks))]
-    lines += [' '.join(str(i) for i in point) for point in landmarks]
-    with open(path_file, 'w') as fp:
-        fp.write('\n'.join(lines))
+    if check_folder:
+        assert os.path.isdir(os.path.dirname(path_file)), \
+            'missing folder "%s"' % os.path.dirname(path_file)
+    write_landmarks_txt(path_file, format_landmarks_lines(landmarks))
 
 
-def save_landmarks_csv(path_file, landmarks):
+def save_landmarks_csv(path_file, landmarks, check_folder=True):
     """ save landmarks into a csv file
 
     :param str path_file: path to the output file
     :param landmarks: np.array<np_points, dim>
+    :param bool check_folder: verify that the output folder exists
     """
-    assert os.path.isdir(os.path.dirname(path_file)), \
-        'missing folder "%s"' % os.path.dirname(path_file)
+    if check_folder:
+        assert os.path.isdir(os.path.dirname(path_file)), \
+            'missing folder "%s"' % os.path.dirname(path_file)
     assert os.path.splitext(path_file)[-1] == '.csv', \
         'wrong file extension "%s"' % os.path.basename(path_file)
-    df = pd.DataFrame(landmarks, columns=LANDMARK_COORDS)
-    df.to_csv(path_file)
+    write_landmarks_csv(path_file, format_landmarks_lines(landmarks))
+
+
+def save_landmarks_npy(path_file, landmarks, check_folder=True):
+    """ save landmarks into a binary numpy file, which is much faster to load
+    than text formats, so use it if the landmarks are not shared outside
+
+    :param str path_file: path to the output file
+    :param landmarks: np.array<np_points, dim>
+    :param bool check_folder: verify that the output folder exists
+    """
+    if check_folder:
+        assert os.path.isdir(os.path.dirname(path_file)), \
+            'missing folder "%s"' % os.path.dirname(path_file)
+    assert os.path.splitext(path_file)[-1] == '.npy', \
+        'wrong file extension "%s"' % os.path.basename(path_file)
+    landmarks = np.asarray(landmarks).astype(LANDMARK_DTYPE, copy=False)
+    np.save(path_file, landmarks)
 
 
 def update_path(path_file, lim_depth=5, absolute=True):
     """ bubble in the folder tree up intil it found desired file
     otherwise return original one
 
+    The found paths are cached per process, a cached path is used only
+    while it still exists, otherwise the folder tree is searched again.
+
     :param str path_file: original path
     :param int lim_depth: lax depth of going up
     :param bool absolute: return absolute path
@@ -162,20 +314,32 @@ def update_path(path_file, lim_depth=5, absolute=True):
     >>> os.path.exists(update_path('~', absolute=False))
     True
     """
-    if path_file.startswith('/'):
+    if os.path.isabs(path_file):
         return path_file
     elif path_file.startswith('~'):
         path_file = os.path.expanduser(path_file)
 
-    tmp_path = path_file
-    for _ in range(lim_depth):
-        if os.path.exists(tmp_path):
-            path_file = tmp_path
-            break
-        tmp_path = os.path.join('..', tmp_path)
+    path_cwd = os.getcwd()
+    key = (path_cwd, path_file, lim_depth)
+    # drop the cached path if it was removed or moved meanwhile
+    path_cached = CACHE_UPDATED_PATHS.pop(key, None)
+    if path_cached is not None and os.path.exists(path_cached):
+        # insert it back as the most recently used
+        CACHE_UPDATED_PATHS[key] = path_file = path_cached
+    else:
+        tmp_path = path_file
+        for _ in range(lim_depth):
+            if os.path.exists(tmp_path):
+                path_file = tmp_path
+                # remember only existing paths, missing may be created later
+                CACHE_UPDATED_PATHS[key] = path_file
+                if len(CACHE_UPDATED_PATHS) > CACHE_UPDATED_PATHS_SIZE:
+                    CACHE_UPDATED_PATHS.popitem(last=False)
+                break
+            tmp_path = os.path.join('..', tmp_path)
 
     if absolute:
-        path_file = os.path.abspath(path_file)
+        path_file = os.path.normpath(os.path.join(path_cwd, path_file))
     return path_file
 
 
@@ -190,12 +354,28 @@ def load_image(path_image):
     >>> img2 = load_image('./test_image.jpg')
     >>> img2.max() <= 1.
     True
+    >>> img2.dtype
+    dtype('float32')
     >>> os.remove('./test_image.jpg')
+    >>> img = Image.fromarray(np.array([[0, 255], [4096, 65535]], dtype=np.uint16))
+    >>> img.save('./test_image.png')
+    >>> np.round(load_image('./test_image.png'), 4)
+    array([[ 0.    ,  0.0039],
+           [ 0.0625,  1.    ]], dtype=float32)
+    >>> os.remove('./test_image.png')
     """
     assert os.path.isfile(path_image), 'missing image "%s"' % path_image
-    image = np.array(Image.open(path_image))
-    while image.max() > 1.:
-        image = (image / 255.)
+    img = Image.open(path_image)
+    image = np.asarray(img)
+    # the value range is given by the image type, so no need to scan values
+    if np.issubdtype(image.dtype, np.integer):
+        # PIL may open 16-bit images also as 32-bit integers ('I' mode)
+        max_val = 65535 if img.mode.startswith('I') else np.iinfo(image.dtype).max
+        scale = 1. / max_val
+        image = image.astype(np.float32)
+        image *= scale
+    else:
+        image = image.astype(np.float32)
     return image
 
 
@@ -211,9 +391,16 @@ def convert_ndarray_2_image(image):
     True
     """
     if isinstance(image, np.ndarray):
-        if np.max(image) <= 1.:
-            image = (image * 255)
-        image = Image.fromarray(np.round(image).astype(np.uint8))
+        # uint8 images are passed to PIL as they are, no rounding or casting
+        if image.dtype != np.uint8:
+            # integer images are already in range (0, 255), others in (0, 1)
+            scale = 1. if np.issubdtype(image.dtype, np.integer) else 255.
+            # single temporary array, rounded and clipped in place
+            image = np.multiply(image, scale)
+            np.rint(image, out=image)
+            np.clip(image, 0, 255, out=image)
+            image = image.astype(np.uint8)
+        image = Image.fromarray(image)
     return image
 
 
@@ -223,9 +410,9 @@ def save_image(path_image, image):
     :param str path_image: path to the image
     :param image: np.array<height, width, ch>
     """
-    image = convert_ndarray_2_image(image)
     path_dir = os.path.dirname(path_image)
     if os.path.isdir(path_dir):
+        image = convert_ndarray_2_image(image)
         image.save(path_image)
     else:
         logging.error('upper folder does not exists: "%s"', path_dir)
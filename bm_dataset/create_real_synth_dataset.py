@@ -27,7 +27,6 @@ if os.environ.get('DISPLAY', '') == '':
 
 import tqdm
 import numpy as np
-import pandas as pd
 from PIL import Image
 from scipy import ndimage, stats, interpolate
 import matplotlib.pyplot as plt
@@ -255,7 +254,7 @@ def export_image_landmarks(image, points, idx, path_out, name_img,
     # export landmarks
     path_csv = os.path.join(path_out, name_img + '_%i.csv' % idx)
     logging.debug('exporting points #%i: %s', idx, path_csv)
-    pd.DataFrame(points, columns=COLUMNS_COORD).to_csv(path_csv)
+    tl_io.save_landmarks_csv(path_csv, points)
     if visual:  # visualisation
         fig = draw_image_landmarks(image, points)
         path_fig = os.path.join(path_out, name_img + '_%i_landmarks.png' % idx)
@@ -306,8 +305,7 @@ def main(params):
 
     image = np.array(Image.open(params['path_image']))
     logging.debug('loaded image, shape: %s', image.shape)
-    df_points = pd.read_csv(params['path_landmarks'], index_col=0)
-    points = df_points[COLUMNS_COORD].values
+    points = tl_io.load_landmarks_csv(params['path_landmarks'])
     logging.debug('loaded landmarks, dim: %s', points.shape)
 
     name_img = get_name(params['path_image'])
@@ -36,9 +36,12 @@ Copyright (C) 2017-2018 Jiri Borovec <jiri.borovec@fel.cvut.cz>
 from __future__ import absolute_import
 
 import os
+import re
 import sys
+import mmap
 import logging
 import shutil
+import contextlib
 
 import numpy as np
 
@@ -133,34 +136,35 @@ def extend_parse(a_parser):
     return a_parser
 
 
-def load_parse_bunwarpj_displacement_axis(fp, size, points):
-    """ given pointer in the file aiming to the beginning of displacement
-     parse all lines and if in the particular line is a point from list
-     get its new position
+def load_parse_bunwarpj_displacement_axis(mm, line_begins, size, points, out=None):
+    """ given memory mapped file and beginnings of the displacement lines
+     parse the lines holding any point from list and get its new position
 
-    :param fp: file pointer
+    :param mm: memory mapped content of the transform file
+    :param line_begins: np.array<height + 1> positions of the displacement lines
+        in the file, the last one closes the last line
     :param (int, int) size: width, height of the image
-    :param points: np.array<nb_points, 2>
-    :return list: list of new positions on given axis (x/y) for related points
+    :param points: np.array<nb_points, 2> integer (x, y) positions of points
+    :param out: np.array<nb_points> optional array to write the positions in
+    :return: np.array<nb_points> new positions on given axis (x/y)
+        for related points
     """
     width, height = size
-    points = np.round(points)
-    selected_lines = points[:, 1].tolist()
-    pos_new = [0] * len(points)
-
-    # walk thor all lined of this displacement field
-    for i in range(height):
-        line = fp.readline()
-        # if the any point is listed in this line
-        if i in selected_lines:
-            pos = line.rstrip().split()
-            # pos = [float(e) for e in pos if len(e)>0]
-            assert len(pos) == width
-            # find all points in this line
-            for j, point in enumerate(points):
-                if point[1] == i:
-                    pos_new[j] = float(pos[point[0]])
-    return pos_new
+    # sorted unique lines with any point, other lines are not parsed at all
+    rows, idx_rows = np.unique(points[:, 1], return_inverse=True)
+    # parse all selected lines in a single call of the numpy (C) parser
+    text = b' '.join([mm[line_begins[i]:line_begins[i + 1]] for i in rows])
+    grid = np.fromstring(text, dtype=tl_io.LANDMARK_DTYPE, sep=' ')
+    assert grid.size == len(rows) * width, \
+        'loaded %i displacements does not match %i lines of width %i' \
+        % (grid.size, len(rows), width)
+    grid = grid.reshape(len(rows), width)
+    if out is None:
+        out = np.empty(len(points), dtype=grid.dtype)
+    # pick all points by their parsed line and column position
+    idx = idx_rows * width + points[:, 0]
+    np.take(grid, idx, out=out)
+    return out
 
 
 def load_parse_bunwarpj_displacements_warp_points(path_file, points):
@@ -193,36 +197,39 @@ def load_parse_bunwarpj_displacements_warp_points(path_file, points):
     >>> pts  # doctest: +NORMALIZE_WHITESPACE
     array([[ 12.,  21.],
            [ 15.,  20.],
-           [ 13.,  23.]])
+           [ 13.,  23.]], dtype=float32)
+    >>> load_parse_bunwarpj_displacements_warp_points(
+    ...                             './my_transform.txt', np.array([[-1, 2]]))
     >>> os.remove('./my_transform.txt')
     """
     if not os.path.isfile(path_file):
         logging.warning('missing transform file "%s"', path_file)
         return None
 
-    fp = open(path_file, 'r')
-    # read image sizes
-    width = int(fp.readline().split('=')[-1])
-    height = int(fp.readline().split('=')[-1])
-    logging.debug('loaded image size: %i x %i', width, height)
-    size = (width, height)
-    if not all(np.max(points, axis=0) <= size):
-        logging.warning('some points are outside of the transformation domain')
-        return None
-
-    # read inter line
-    fp.readline()
-    fp.readline()
-    # read inter line and Transform notation
-    points_x = load_parse_bunwarpj_displacement_axis(fp, size, points)
-
-    # read inter line and Transform notation
-    fp.readline(), fp.readline()
-    # read Y Trans
-    points_y = load_parse_bunwarpj_displacement_axis(fp, size, points)
-    fp.close()
+    with open(path_file, 'rb') as fp, \
+            contextlib.closing(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)) as mm:
+        # read image sizes
+        width = int(re.search(br'Width=(\d+)', mm).group(1))
+        height = int(re.search(br'Height=(\d+)', mm).group(1))
+        logging.debug('loaded image size: %i x %i', width, height)
+        size = (width, height)
+        # the points are used only as indexes, so cast them just once
+        points = np.round(points).astype(np.intp)
+        if np.any(points < 0) or not all(np.max(points, axis=0) < size):
+            logging.warning('some points are outside of the transformation domain')
+            return None
+
+        # positions of all line ends, the last line does not have to be closed
+        line_ends = np.flatnonzero(np.frombuffer(mm, dtype=np.uint8) == ord('\n'))
+        line_ends = np.append(line_ends, len(mm))
+        points_new = np.empty((len(points), 2), dtype=tl_io.LANDMARK_DTYPE)
+        for i, marker in enumerate([b'X Trans', b'Y Trans']):
+            # the displacement lines follow the line with Transform notation
+            idx = np.searchsorted(line_ends, mm.find(marker))
+            load_parse_bunwarpj_displacement_axis(
+                mm, line_ends[idx:idx + height + 1] + 1, size, points,
+                out=points_new[:, i])
 
-    points_new = np.vstack((points_x, points_y)).T
     return points_new
 
 